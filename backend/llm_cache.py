@@ -0,0 +1,32 @@
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Optional
+
+class LLMCache:
+    # Exact-match cache for LLM responses, keyed by a hash of the full request
+    # payload. With temperature=0 the same prompt yields the same output, so a
+    # hit saves the whole API round-trip. Bounded LRU so memory stays flat.
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def make_key(**request_payload) -> str:
+        return hashlib.sha256(json.dumps(request_payload, sort_keys=True).encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    async def set(self, key: str, value: str) -> None:
+        async with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
@@ -1,17 +1,27 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
-import whisper
+import openai
+from openai import AsyncOpenAI
+from faster_whisper import WhisperModel
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+import httpx
+import tiktoken
+import asyncio
 import json
+import logging
 from typing import List, Dict, Optional
-import re
 from dotenv import load_dotenv
 import os
+import tempfile
+from llm_cache import LLMCache
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Medical Documentation System", description="API for generating OASIS-E1 documentation from transcripts")
 
 # CORS setup for frontend communication
@@ -27,10 +37,62 @@ app.add_middleware(
 openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
     raise ValueError("OPENAI_API_KEY not found in environment variables")
-client = OpenAI(api_key=openai_api_key)
+# Shared HTTP/2 connection pool sized for the concurrent fan-out, so parallel
+# calls multiplex over one TLS session instead of re-handshaking
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    timeout=60.0
+)
+client = AsyncOpenAI(api_key=openai_api_key, http_client=http_client)
+
+# Cap concurrent OpenAI requests to stay within rate limits
+openai_semaphore = asyncio.Semaphore(20)
+
+# Response cache: identical prompts (same transcript and element) skip the API entirely
+llm_cache = LLMCache()
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)),
+    reraise=True
+)
+async def create_chat_completion(**kwargs):
+    # Retry transient failures with jittered backoff; the semaphore caps
+    # in-flight requests across retries as well
+    async with openai_semaphore:
+        return await client.chat.completions.create(**kwargs)
+
+# Tokenize once per request and cap transcript length; every downstream call
+# pays for the transcript, so trimming here compounds across elements
+TRANSCRIPT_TOKEN_LIMIT = 6000
+token_encoder = tiktoken.encoding_for_model("gpt-4o")
+
+def trim_transcript(transcript: str, limit: int = TRANSCRIPT_TOKEN_LIMIT) -> str:
+    tokens = token_encoder.encode(transcript)
+    if len(tokens) <= limit:
+        return transcript
+    # Keep the tail of the visit, which carries the most recent findings
+    return token_encoder.decode(tokens[-limit:])
 
-# Whisper model for transcription
-whisper_model = whisper.load_model("base")
+# Whisper model for transcription, loaded lazily on the first /transcribe so
+# workers that only generate documentation start instantly and never pay the
+# model's memory footprint
+_whisper_model = None
+
+def get_whisper_model() -> WhisperModel:
+    global _whisper_model
+    if _whisper_model is None:
+        # CTranslate2 backend, int8 quantized, GPU when available
+        _whisper_model = WhisperModel("base", device="auto", compute_type="int8")
+    return _whisper_model
+
+def transcribe_audio_file(path: str) -> str:
+    # faster-whisper returns a lazy segment generator; consume it here so the
+    # whole decode runs inside the caller's worker thread
+    segments, _ = get_whisper_model().transcribe(path, vad_filter=True)
+    return " ".join(segment.text.strip() for segment in segments)
 
 # Documentation elements definition
 class DocumentationElement(BaseModel):
@@ -47,6 +109,9 @@ class StructuredOutput(BaseModel):
     elements: Dict[str, Optional[Dict]]
     errors: Dict[str, Optional[str]]
 
+class BatchTranscriptsInput(BaseModel):
+    transcripts: List[str]
+
 # In-memory storage for elements (for simplicity)
 ELEMENTS = [
     DocumentationElement(
@@ -86,13 +151,74 @@ ELEMENTS = [
     )
 ]
 
+# Per-element JSON schemas, combined into a single response_format when a whole
+# level of elements is extracted in one call
+ELEMENT_SCHEMAS = {
+    "M1033": {
+        "type": "object",
+        "properties": {"risk_factors": {"type": "array", "items": {"type": "string"}}},
+        "additionalProperties": False
+    },
+    "M1800": {
+        "type": "object",
+        "properties": {"grooming_ability": {"type": "string"}},
+        "additionalProperties": False
+    },
+    "M1830": {
+        "type": "object",
+        "properties": {"bathing_ability": {"type": "string"}},
+        "additionalProperties": False
+    },
+    "vitals": {
+        "type": "object",
+        "properties": {
+            "heart_rate": {"type": "integer"},
+            "blood_pressure": {"type": "string"},
+            "respiratory_rate": {"type": "integer"},
+            "blood_sugar": {"type": "integer"}
+        },
+        "additionalProperties": False
+    },
+    "summary": {
+        "type": "object",
+        "properties": {"summary": {"type": "string"}},
+        "additionalProperties": False
+    }
+}
+
+def build_element_levels(elements: List[DocumentationElement]) -> List[List[DocumentationElement]]:
+    # Group elements into dependency levels (Kahn's algorithm) so that all
+    # elements in one level can be processed concurrently
+    remaining = {element.id: element for element in elements}
+    resolved = set()
+    levels = []
+    while remaining:
+        level = [element for element in remaining.values() if all(dep in resolved for dep in element.depends_on)]
+        if not level:
+            raise ValueError(f"Circular dependency detected among elements: {list(remaining)}")
+        levels.append(level)
+        for element in level:
+            resolved.add(element.id)
+            del remaining[element.id]
+    return levels
+
+# Computed once at startup; elements in the same level have no dependencies on each other
+ELEMENT_LEVELS = build_element_levels(ELEMENTS)
+
+# Dependency sets by element id, so building an element's context is a direct
+# key lookup instead of a scan over all accumulated results
+ELEMENT_DEPS = {element.id: frozenset(element.depends_on) for element in ELEMENTS}
+
+DIARIZATION_KEYWORDS = ("patient says", "they report", "states")
+
 def diarize_transcript(transcript: str) -> Dict[str, str]:
-    # Simple rule-based diarization (clinician vs patient)
-    sentences = transcript.split(". ")
+    # Simple rule-based diarization (clinician vs patient); lowercase each
+    # sentence once rather than once per keyword
     clinician = []
     patient = []
-    for sentence in sentences:
-        if any(keyword in sentence.lower() for keyword in ["patient says", "they report", "states"]):
+    for sentence in transcript.split(". "):
+        lowered = sentence.lower()
+        if any(keyword in lowered for keyword in DIARIZATION_KEYWORDS):
             patient.append(sentence)
         else:
             clinician.append(sentence)
@@ -101,97 +227,276 @@ def diarize_transcript(transcript: str) -> Dict[str, str]:
         "patient": ". ".join(patient)
     }
 
-def clean_response_content(content: str) -> str:
-    # Remove markdown code fences and trim whitespace
-    content = re.sub(r'^```json\n|```$', '', content, flags=re.MULTILINE)
-    return content.strip()
+# Human-readable format hints per element, used in the per-element prompt
+OUTPUT_FORMAT = {
+    "M1033": 'A JSON object with a "risk_factors" field containing a list of strings, e.g., {"risk_factors": ["history of falls", "uncontrolled diabetes"]}',
+    "M1800": 'A JSON object with a "grooming_ability" field containing a string, e.g., {"grooming_ability": "Needs assistance with grooming"}',
+    "M1830": 'A JSON object with a "bathing_ability" field containing a string, e.g., {"bathing_ability": "Able to bathe independently"}',
+    "vitals": 'A JSON object with fields "heart_rate" (integer), "blood_pressure" (string), "respiratory_rate" (integer), "blood_sugar" (integer), e.g., {"heart_rate": 78, "blood_pressure": "118/72", "respiratory_rate": 14, "blood_sugar": 130}',
+    "summary": 'A JSON object with a "summary" field containing a string, e.g., {"summary": "Patient is stable with normal vital signs"}'
+}
 
-async def process_element(transcript: str, element: DocumentationElement, previous_results: Dict) -> tuple[Optional[Dict], Optional[str]]:
-    print(f"Processing element {element.name} with transcript: {transcript}")  # Debugging log
-    output_format = {
-        "M1033": 'A JSON object with a "risk_factors" field containing a list of strings, e.g., {"risk_factors": ["history of falls", "uncontrolled diabetes"]}',
-        "M1800": 'A JSON object with a "grooming_ability" field containing a string, e.g., {"grooming_ability": "Needs assistance with grooming"}',
-        "M1830": 'A JSON object with a "bathing_ability" field containing a string, e.g., {"bathing_ability": "Able to bathe independently"}',
-        "vitals": 'A JSON object with fields "heart_rate" (integer), "blood_pressure" (string), "respiratory_rate" (integer), "blood_sugar" (integer), e.g., {"heart_rate": 78, "blood_pressure": "118/72", "respiratory_rate": 14, "blood_sugar": 130}',
-        "summary": 'A JSON object with a "summary" field containing a string, e.g., {"summary": "Patient is stable with normal vital signs"}'
-    }
-    prompt = f"""
+def build_prompt_template(element: DocumentationElement) -> str:
+    # Pre-render the per-element prompt with the name, description, and format
+    # hint baked in; only {transcript} and {previous_results} remain for the
+    # per-request str.format call. Static braces are doubled to survive it.
+    format_hint = OUTPUT_FORMAT[element.id].replace("{", "{{").replace("}", "}}")
+    return f"""
     You are a medical documentation assistant. Extract information from the following transcript relevant to {element.name} ({element.description}):
-    Transcript: {transcript}
+    Transcript: {{transcript}}
 
-    Previous results for context: {json.dumps(previous_results, indent=2)}
+    Previous results for context: {{previous_results}}
 
     Rules:
     - Extract only information explicitly present in the transcript. Do not infer or add data not mentioned.
-    - Return a valid JSON object matching the format: {output_format[element.id]}.
-    - If there is insufficient information, return an empty object {{}}.
-    - Output only JSON, with no markdown, code fences, or additional text.
+    - Return a valid JSON object matching the format: {format_hint}.
+    - If there is insufficient information, return an empty object {{{{}}}}.
 
     Examples:
-    - For Risk for Hospitalization: {{"risk_factors": ["history of falls"]}} or {{}}
-    - For Vital Signs: {{"heart_rate": 78, "blood_pressure": "118/72", "respiratory_rate": 14, "blood_sugar": 130}} or {{}}
-    - For insufficient information: {{}}
+    - For Risk for Hospitalization: {{{{"risk_factors": ["history of falls"]}}}} or {{{{}}}}
+    - For Vital Signs: {{{{"heart_rate": 78, "blood_pressure": "118/72", "respiratory_rate": 14, "blood_sugar": 130}}}} or {{{{}}}}
+    - For insufficient information: {{{{}}}}
     """
+
+PROMPT_TEMPLATES = {element.id: build_prompt_template(element) for element in ELEMENTS}
+
+async def process_element(transcript: str, element: DocumentationElement, previous_results: Dict) -> tuple[Optional[Dict], Optional[str]]:
+    logger.debug("Processing element %s with transcript: %s", element.name, transcript)
+    prompt = PROMPT_TEMPLATES[element.id].format(
+        transcript=transcript,
+        previous_results=json.dumps(previous_results, separators=(",", ":"))
+    )
+    messages = [
+        {"role": "system", "content": "You are a medical documentation assistant that outputs only valid JSON."},
+        {"role": "user", "content": prompt}
+    ]
+    # Structured output: the API guarantees the response parses as this schema,
+    # so no fence-stripping or reparse retries are needed
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": element.id, "schema": ELEMENT_SCHEMAS[element.id]}
+    }
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a medical documentation assistant that outputs only valid JSON, with no markdown or code fences."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=500
-        )
-        raw_content = response.choices[0].message.content
-        print(f"Raw response for {element.name}: {raw_content}")  # Debugging log
-        cleaned_content = clean_response_content(raw_content)
-        result = json.loads(cleaned_content)
+        # temperature=0 keeps outputs deterministic, so cached responses stay valid
+        cache_key = llm_cache.make_key(model="gpt-4o", messages=messages, temperature=0, response_format=response_format)
+        raw_content = await llm_cache.get(cache_key)
+        if raw_content is None:
+            response = await create_chat_completion(
+                model="gpt-4o",
+                messages=messages,
+                temperature=0,
+                max_tokens=500,
+                response_format=response_format
+            )
+            raw_content = response.choices[0].message.content
+            await llm_cache.set(cache_key, raw_content)
+        logger.debug("Raw response for %s: %s", element.name, raw_content)
+        result = json.loads(raw_content)
         return result if result != {} else None, None
     except json.JSONDecodeError as e:
         error_msg = f"JSON parsing error for {element.name}: {e}, raw content: {raw_content}"
-        print(error_msg)
+        logger.error(error_msg)
         return None, error_msg
     except Exception as e:
         error_msg = f"Error processing element {element.name}: {e}"
-        print(error_msg)
+        logger.error(error_msg)
         return None, error_msg
 
+def build_combined_request(transcript: str, elements: List[DocumentationElement]) -> tuple[List[Dict], Dict]:
+    # Messages and response_format for extracting several elements in one
+    # call; shared by the real-time level path and the offline Batch API path
+    task_list = "\n".join(f'- "{element.id}": {element.name} ({element.description})' for element in elements)
+    prompt = f"""
+    You are a medical documentation assistant. Extract information from the following transcript for each documentation element listed below:
+    Transcript: {transcript}
+
+    Elements:
+    {task_list}
+
+    Rules:
+    - Extract only information explicitly present in the transcript. Do not infer or add data not mentioned.
+    - Return a single JSON object with one key per element id.
+    - If there is insufficient information for an element, use an empty object {{}} for that element.
+    """
+    messages = [
+        {"role": "system", "content": "You are a medical documentation assistant that outputs only valid JSON."},
+        {"role": "user", "content": prompt}
+    ]
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "documentation_elements",
+            "schema": {
+                "type": "object",
+                "properties": {element.id: ELEMENT_SCHEMAS[element.id] for element in elements},
+                "required": [element.id for element in elements],
+                "additionalProperties": False
+            }
+        }
+    }
+    return messages, response_format
+
+async def process_elements_batch(transcript: str, elements: List[DocumentationElement]) -> tuple[Dict[str, Optional[Dict]], Dict[str, str]]:
+    # Extract a whole level of independent elements in one API call: the
+    # transcript is sent once and the response schema covers every element
+    logger.debug("Processing batch %s with transcript: %s", [e.id for e in elements], transcript)
+    messages, response_format = build_combined_request(transcript, elements)
+    results = {}
+    errors = {}
+    try:
+        cache_key = llm_cache.make_key(model="gpt-4o", messages=messages, temperature=0, response_format=response_format)
+        raw_content = await llm_cache.get(cache_key)
+        if raw_content is None:
+            response = await create_chat_completion(
+                model="gpt-4o",
+                messages=messages,
+                temperature=0,
+                max_tokens=1000,
+                response_format=response_format
+            )
+            raw_content = response.choices[0].message.content
+            await llm_cache.set(cache_key, raw_content)
+        logger.debug("Raw batch response: %s", raw_content)
+        parsed = json.loads(raw_content)
+        for element in elements:
+            result = parsed.get(element.id, {})
+            results[element.id] = result if result != {} else None
+    except json.JSONDecodeError as e:
+        error_msg = f"JSON parsing error for batch: {e}, raw content: {raw_content}"
+        logger.error(error_msg)
+        for element in elements:
+            results[element.id] = None
+            errors[element.id] = error_msg
+    except Exception as e:
+        error_msg = f"Error processing batch: {e}"
+        logger.error(error_msg)
+        for element in elements:
+            results[element.id] = None
+            errors[element.id] = error_msg
+    return results, errors
+
 @app.post("/transcribe", response_model=Dict)
 async def transcribe_audio(file: UploadFile = File(...)):
     if not file.content_type.startswith("audio/"):
         raise HTTPException(status_code=400, detail="File must be an audio file")
     
-    audio_data = await file.read()
-    with open("temp_audio.wav", "wb") as f:
-        f.write(audio_data)
-    
+    # Stream the upload into a per-request temp file so memory stays O(1) and
+    # concurrent uploads don't overwrite each other
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as f:
+        tmp_path = f.name
+        while chunk := await file.read(1 << 20):
+            f.write(chunk)
+
     try:
-        result = whisper_model.transcribe("temp_audio.wav")
-        diarized = diarize_transcript(result["text"])
+        # Run the CPU/GPU-bound decode in a worker thread so the event loop
+        # keeps serving other requests
+        text = await asyncio.to_thread(transcribe_audio_file, tmp_path)
+        diarized = diarize_transcript(text)
         return {
-            "transcript": result["text"],
+            "transcript": text,
             "diarization": diarized
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
+    finally:
+        os.unlink(tmp_path)
 
-@app.post("/generate_documentation", response_model=StructuredOutput)
+@app.post("/generate_documentation")
 async def generate_documentation(input: TranscriptInput):
-    diarized = diarize_transcript(input.transcript)
-    results = {}
-    errors = {}
-    
-    # Ordered execution
-    for element in ELEMENTS:
-        result, error = await process_element(
-            transcript=diarized["clinician"] + " " + diarized["patient"],
-            element=element,
-            previous_results={k: v for k, v in results.items() if k in element.depends_on}
+    # Streams one NDJSON line per element as it completes, so the frontend can
+    # render fields progressively instead of waiting for the whole document.
+    # The final line carries the aggregate StructuredOutput payload.
+    # No diarization here: the old code split the transcript apart and
+    # concatenated it straight back before prompting, so pass it through as-is
+    async def stream():
+        transcript = trim_transcript(input.transcript)
+        results = {}
+        errors = {}
+
+        # Ordered execution: a level with several elements is extracted in one
+        # combined call; levels still run in dependency order
+        for level in ELEMENT_LEVELS:
+            if len(level) > 1:
+                level_results, level_errors = await process_elements_batch(
+                    transcript=transcript,
+                    elements=level
+                )
+                results.update(level_results)
+                errors.update(level_errors)
+                for element in level:
+                    yield json.dumps({"id": element.id, "result": results[element.id], "error": level_errors.get(element.id)}) + "\n"
+            else:
+                element = level[0]
+                result, error = await process_element(
+                    transcript=transcript,
+                    element=element,
+                    previous_results={k: results[k] for k in ELEMENT_DEPS[element.id] if k in results}
+                )
+                results[element.id] = result
+                if error:
+                    errors[element.id] = error
+                yield json.dumps({"id": element.id, "result": result, "error": error}) + "\n"
+
+        yield json.dumps({"done": True, **StructuredOutput(elements=results, errors=errors).model_dump()}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/generate_documentation_batch", response_model=Dict)
+async def generate_documentation_batch(input: BatchTranscriptsInput):
+    # Offline bulk path: submit every transcript as one OpenAI Batch API job
+    # (results within 24h at half the per-token cost of real-time calls).
+    # Each transcript becomes one combined-schema request covering all
+    # elements; summary is generated from the transcript directly since batch
+    # jobs cannot chain on earlier results.
+    lines = []
+    for i, transcript in enumerate(input.transcripts):
+        messages, response_format = build_combined_request(trim_transcript(transcript), ELEMENTS)
+        lines.append(json.dumps({
+            "custom_id": f"transcript-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o",
+                "messages": messages,
+                "temperature": 0,
+                "max_tokens": 1500,
+                "response_format": response_format
+            }
+        }))
+    try:
+        batch_file = await client.files.create(
+            file=("documentation_batch.jsonl", "\n".join(lines).encode()),
+            purpose="batch"
         )
-        results[element.id] = result
-        if error:
-            errors[element.id] = error
-    
-    return StructuredOutput(elements=results, errors=errors)
+        batch = await client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Batch submission failed: {str(e)}")
+    return {"batch_id": batch.id, "status": batch.status}
+
+@app.get("/generate_documentation_batch/{batch_id}", response_model=Dict)
+async def get_documentation_batch(batch_id: str):
+    # Poll a submitted batch job; once completed, download and parse results
+    # keyed by the custom_id assigned at submission
+    try:
+        batch = await client.batches.retrieve(batch_id)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"Batch not found: {str(e)}")
+    if batch.status != "completed":
+        return {"batch_id": batch.id, "status": batch.status}
+    output = await client.files.content(batch.output_file_id)
+    results = {}
+    for line in output.text.splitlines():
+        if not line.strip():
+            continue
+        entry = json.loads(line)
+        content = entry["response"]["body"]["choices"][0]["message"]["content"]
+        parsed = json.loads(content)
+        results[entry["custom_id"]] = {element_id: (value if value != {} else None) for element_id, value in parsed.items()}
+    return {"batch_id": batch.id, "status": batch.status, "results": results}
 
 @app.get("/elements", response_model=List[DocumentationElement])
 async def get_elements():
@@ -42,10 +42,36 @@ const App = () => {
   const handleGenerateDocumentation = async () => {
     setLoading(true);
     setErrorMessage('');
+    setDocumentation({});
+    setErrors({});
     try {
-      const response = await axios.post('http://localhost:8000/generate_documentation', { transcript });
-      setDocumentation(response.data.elements);
-      setErrors(response.data.errors);
+      // The backend streams NDJSON: one line per element as it completes,
+      // so results render progressively
+      const response = await fetch('http://localhost:8000/generate_documentation', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ transcript }),
+      });
+      if (!response.ok) throw new Error(`HTTP ${response.status}`);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const update = JSON.parse(line);
+          if (update.done) continue;
+          setDocumentation(prev => ({ ...prev, [update.id]: update.result }));
+          if (update.error) {
+            setErrors(prev => ({ ...prev, [update.id]: update.error }));
+          }
+        }
+      }
     } catch (error) {
       console.error('Error generating documentation:', error);
       setErrorMessage('Failed to generate documentation. Please try again.');